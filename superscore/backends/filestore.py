@@ -5,11 +5,14 @@ Backend for configurations backed by files
 import contextlib
 import json
 import logging
+import math
 import os
-import shutil
+import re
+import stat
 from dataclasses import fields, replace
-from typing import Any, Dict, Generator, Optional, Union
-from uuid import UUID, uuid4
+from typing import (Any, Dict, Generator, Iterable, List, Optional, Set,
+                    Union)
+from uuid import UUID
 
 from apischema import deserialize, serialize
 
@@ -18,19 +21,152 @@ from superscore.errors import BackendError
 from superscore.model import Entry, Root
 from superscore.utils import build_abs_path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# number of journaled modifications before they are folded into the database
+MAX_JOURNAL_LENGTH = 100
+
+
+# orjson parses integers that may not fit in 64 bits as floats.  Any 20 digit
+# integer, or a 19 digit negative one, may fall outside int64/uint64
+_LONG_INT = re.compile(rb'-[0-9]{19}|[0-9]{20}')
+
+
+# the only Entry fields that can hold a float
+_FLOAT_FIELDS = ('data', 'abs_tolerance', 'rel_tolerance', 'timeout')
+
+
+def _has_non_finite(entries: Iterable[Entry]) -> bool:
+    """
+    Return True if any of ``entries`` holds a NaN or infinite float.
+
+    Only the fields that can hold a float are checked, along with any Entry
+    objects nested in ``entries`` (readbacks, meta_pvs and children not yet
+    swapped to uuids).  This is much cheaper than walking the serialized
+    payload.
+    """
+    stack = list(entries)
+    while stack:
+        attrs = vars(stack.pop())
+        for name in _FLOAT_FIELDS:
+            value = attrs.get(name)
+            if value.__class__ is float and not math.isfinite(value):
+                return True
+        readback = attrs.get('readback')
+        if readback is not None:
+            stack.append(readback)
+        stack.extend(attrs.get('meta_pvs', ()))
+        for child in attrs.get('children', ()):
+            if not isinstance(child, UUID):
+                stack.append(child)
+    return False
+
+
+def _dumps(obj: Any, pretty: bool = False, finite: bool = True) -> bytes:
+    """
+    Serialize ``obj`` to newline-terminated JSON bytes.
+
+    orjson is only used if it can represent ``obj`` exactly.  It writes NaN
+    and infinities as null and cannot write integers beyond 64 bits, so the
+    stdlib json module is used for those.  Callers pass ``finite=False`` if
+    ``obj`` may hold a non-finite float, see `_has_non_finite`.
+    """
+    if orjson is not None and finite:
+        option = orjson.OPT_APPEND_NEWLINE
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:
+            # integer exceeds 64-bit range
+            pass
+
+    if pretty:
+        json_kwargs = {'indent': 2}
+    else:
+        json_kwargs = {'separators': (',', ':')}
+    return (json.dumps(obj, **json_kwargs) + '\n').encode()
+
+
+def _references(entry: Entry) -> Set[int]:
+    """Return the ``UUID.int`` of each flattened entry referenced by ``entry``"""
+    refs = set()
+    for field in fields(entry):
+        if field.name == 'uuid':
+            continue
+        field_data = getattr(entry, field.name)
+        if isinstance(field_data, list):
+            refs.update(item.int for item in field_data if isinstance(item, UUID))
+        elif isinstance(field_data, UUID):
+            refs.add(field_data.int)
+    return refs
+
+
+def _copy_entry(entry: Entry) -> Entry:
+    """
+    Return a copy of a cached ``entry`` that can be modified without affecting
+    the cache.  Lists, sets and nested entries are copied, uuid references and
+    other immutable values are shared.
+    """
+    entry = replace(entry)
+    for field in fields(entry):
+        field_data = getattr(entry, field.name)
+        if isinstance(field_data, Entry):
+            setattr(entry, field.name, _copy_entry(field_data))
+        elif isinstance(field_data, list):
+            setattr(entry, field.name, [
+                _copy_entry(item) if isinstance(item, Entry) else item
+                for item in field_data
+            ])
+        elif isinstance(field_data, set):
+            setattr(entry, field.name, set(field_data))
+    return entry
+
+
+def _fsync_directory(path: str) -> None:
+    """Flush the directory holding ``path`` to disk, persisting renames"""
+    if os.name != 'posix':
+        # directories cannot be opened for fsync on Windows
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _loads(data: bytes) -> Any:
+    """Deserialize JSON ``data``"""
+    if orjson is not None and not _LONG_INT.search(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson is strict, fall back for non-standard values (NaN, etc)
+            pass
+    return json.loads(data)
+
 
 class FilestoreBackend(_Backend):
     """
     Filestore configuration backend.
 
     Holds an entry cache, filled when a file is loaded.
-    All CRUD operations reconstruct the Root object and save a new version of
-    the database.
+    Operations that modify the database are appended to a journal file
+    alongside the database, which is folded into a new version of the database
+    once it grows long enough, or whenever `.store` is called.
     File storage is a json file containing serialized model dataclasses.
+
+    The entry cache is keyed by ``UUID.int``, which hashes much faster than
+    the `UUID` itself.
     """
-    _entry_cache: Dict[UUID, Entry]
+    _entry_cache: Dict[int, Entry]
+    _pending_ops: List[bytes]
+    _journal_length: int
     _root: Root
 
     def __init__(
@@ -40,21 +176,24 @@ class FilestoreBackend(_Backend):
         cfg_path: Optional[str] = None
     ) -> None:
         self._entry_cache = {}
+        self._pending_ops = []
+        self._journal_length = 0
         self._root = None
-        self.path = path
         if cfg_path is not None:
-            cfg_dir = os.path.dirname(cfg_path)
-            self.path = build_abs_path(cfg_dir, path)
+            self.path = build_abs_path(os.path.dirname(cfg_path), path)
         else:
             self.path = path
 
         if initialize:
             self.initialize()
 
-    def _load_or_initialize(self) -> Dict[str, Any]:
+    def _load_or_initialize(self) -> Dict[int, Any]:
         """
         Load an existing database or initialize a new one.
         Returns the entry cache for this backend
+
+        The entry cache is only built when the database is first loaded.
+        Modifications are applied to it directly, keeping it up to date.
         """
         if self._root is None:
             try:
@@ -63,36 +202,181 @@ class FilestoreBackend(_Backend):
                 logger.debug("Initializing new database")
                 self.initialize()
                 self._root = self.load()
-
-        # flatten create entry cache
-        self._entry_cache = {}
-        for entry in self._root.entries:
-            self.flatten_and_cache(entry)
+            self._rebuild_cache()
+            self._replay_journal()
 
         return self._entry_cache
 
+    @property
+    def journal_path(self) -> str:
+        """Path to the journal of modifications not yet in the database file"""
+        return f"{self.path}.journal"
+
+    def _replay_journal(self) -> None:
+        """
+        Apply the modifications in the journal file to the freshly loaded root
+        and entry cache.
+        """
+        try:
+            with open(self.journal_path, 'rb') as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            data = b''
+
+        complete_length = data.rfind(b'\n') + 1
+        if complete_length < len(data):
+            # a write was interrupted part way through.  Ignore the partial
+            # record, it is dropped from the file before the next append
+            logger.warning("Ignoring incomplete record at end of journal %s",
+                           self.journal_path)
+            data = data[:complete_length]
+
+        ops = []
+        for line in data.splitlines():
+            try:
+                ops.append(_loads(line))
+            except ValueError:
+                logger.warning("Skipping malformed line in journal %s",
+                               self.journal_path)
+
+        self._journal_length = len(ops)
+        if not ops:
+            return
+
+        for op in ops:
+            self._apply_op(op)
+        self._prune_cache()
+
+    def _apply_op(self, op: Dict[str, Any]) -> bool:
+        """
+        Apply a journaled modification to root and the flattened entry cache.
+        Entries are deserialized from the record, so the cache holds the same
+        objects whether the modification is live or replayed from the journal.
+
+        Replaying is idempotent, in case a journal outlived a full store.
+
+        Returns
+        -------
+        bool
+            True if entries may have been left unreachable or referenced after
+            deletion, and the cache should be pruned with `._prune_cache`
+        """
+        key = UUID(op["uuid"]).int
+        old_entry = self._entry_cache.pop(key, None)
+        if op["op"] == "delete":
+            return old_entry is not None
+
+        # replace the cached version, caching anything new it references
+        entry = deserialize(Entry, op["entry"])
+        self._flatten([entry])
+        if old_entry is None:
+            if op["op"] == "save":
+                self._root.entries.append(entry)
+            return False
+        return not _references(old_entry) <= _references(entry)
+
+    def _prune_cache(self) -> None:
+        """
+        Drop cached entries that are no longer reachable from root, along with
+        references to deleted entries, and point root at the cached version of
+        each of its entries.
+
+        This cleans up after modifications without copying and re-flattening
+        every entry, as rebuilding the cache from `.reconstruct_root` would.
+        """
+        reachable = {}
+        stack = [entry.uuid for entry in reversed(self._root.entries)]
+        while stack:
+            key = stack.pop().int
+            if key in reachable or key not in self._entry_cache:
+                continue
+            entry = self._entry_cache[key]
+            reachable[key] = entry
+
+            refs = []
+            for field in fields(entry):
+                if field.name == 'uuid':
+                    continue
+                field_data = getattr(entry, field.name)
+                if isinstance(field_data, list):
+                    # drop references to deleted entries
+                    new_list = [
+                        item for item in field_data
+                        if not isinstance(item, UUID) or item.int in self._entry_cache
+                    ]
+                    if len(new_list) < len(field_data):
+                        setattr(entry, field.name, new_list)
+                    refs.extend(item for item in new_list if isinstance(item, UUID))
+                elif isinstance(field_data, UUID):
+                    refs.append(field_data)
+            stack.extend(reversed(refs))
+
+        self._root.entries = [
+            reachable[entry.uuid.int] for entry in self._root.entries
+            if entry.uuid.int in reachable
+        ]
+        self._entry_cache = reachable
+
+    def _record(self, op: str, entry: Entry) -> None:
+        """
+        Record a modification to the database, to be journaled on store, and
+        apply it to the entry cache.
+        """
+        record = {"op": op, "uuid": str(entry.uuid)}
+        finite = True
+        if op != "delete":
+            record["entry"] = serialize(Entry, entry)
+            finite = not _has_non_finite([entry])
+        self._pending_ops.append(_dumps(record, finite=finite))
+        if self._apply_op(record):
+            self._prune_cache()
+
+    def _rebuild_cache(self) -> None:
+        """
+        Rebuild the entry cache from scratch, flattening every entry in root
+        in a single walk.
+        """
+        self._entry_cache = {}
+        # reverse so root entries are visited in their original order
+        self._flatten(list(reversed(self._root.entries)))
+
     def flatten_and_cache(self, entry: Union[Entry, UUID]) -> None:
         """
-        Flatten ``entry`` recursively, adding it to ``self._entry_cache`` if not
-        present already.
+        Flatten ``entry`` and everything it references, adding each to
+        ``self._entry_cache`` if not present already.
 
-        If ``entry`` is already a UUID, it should have already been cached, and
-        can be skipped.
+        The tree is walked with an explicit stack rather than by recursion, so
+        arbitrarily deep trees can be flattened.  Only this step is depth-safe:
+        rebuilding the tree in ``reconstruct_root`` and (de)serializing it are
+        still recursive, so saving or storing such a tree is bounded by the
+        recursion limit.  UUID references should have already been cached, and
+        are skipped, as are entries already in the cache (along with their
+        references).
 
         Parameters
         ----------
         entry : Union[Entry, UUID]
             entry or uuid reference to flatten and cache
         """
-        if isinstance(entry, UUID):
-            return
-        refs = entry.swap_to_uuids()
-        for ref in refs:
-            if isinstance(ref, Entry):
-                self.maybe_add_to_cache(ref)
-                self.flatten_and_cache(ref)
+        self._flatten([entry])
 
-        self.maybe_add_to_cache(entry)
+    def _flatten(self, stack: List[Union[Entry, UUID]]) -> None:
+        """
+        Flatten and cache every entry in ``stack``, consuming it.  Each entry is
+        visited once, swapping its references to uuids and caching it together.
+        """
+        while stack:
+            current = stack.pop()
+            if isinstance(current, UUID):
+                continue
+            key = current.uuid.int
+            if key in self._entry_cache:
+                continue
+            refs = current.swap_to_uuids()
+            self._entry_cache[key] = current
+            if refs:
+                # reverse so references are visited in their original order
+                stack.extend(reversed(refs))
 
     def maybe_add_to_cache(self, item: Union[Entry, UUID]) -> None:
         """
@@ -105,13 +389,22 @@ class FilestoreBackend(_Backend):
         """
         if isinstance(item, UUID):
             return
-        meta_id = item.uuid
+        meta_id = item.uuid.int
         if meta_id in self._entry_cache:
             # duplicate uuids found
             return
 
         self._entry_cache[meta_id] = item
 
+    def clear_cache(self) -> None:
+        """
+        Clear the entry cache, forcing the database to be re-read from its file
+        on next access.
+        """
+        self._entry_cache = {}
+        self._pending_ops = []
+        self._root = None
+
     def initialize(self):
         """
         Initialize a new JSON file database.
@@ -143,8 +436,8 @@ class FilestoreBackend(_Backend):
 
         new_children = []
         for root_child in self._root.entries:
-            if root_child.uuid in self._entry_cache:
-                new_child = self._entry_cache[root_child.uuid]
+            if root_child.uuid.int in self._entry_cache:
+                new_child = self._entry_cache[root_child.uuid.int]
                 new_children.append(self.fill_uuids(new_child))
 
         new_root.entries = new_children
@@ -176,7 +469,7 @@ class FilestoreBackend(_Backend):
                 new_list = []
                 for item in field_data:
                     if isinstance(item, UUID):
-                        new_ref = self._entry_cache.get(item)
+                        new_ref = self._entry_cache.get(item.int)
                         if new_ref:
                             new_ref = self.fill_uuids(new_ref)
                             new_list.append(new_ref)
@@ -184,41 +477,59 @@ class FilestoreBackend(_Backend):
                 if new_list:
                     setattr(entry, field.name, new_list)
             elif isinstance(field_data, UUID):
-                new_ref = self._entry_cache.get(field_data)
+                new_ref = self._entry_cache.get(field_data.int)
                 if new_ref:
                     new_ref = self.fill_uuids(new_ref)
                     setattr(entry, field.name)
 
         return entry
 
-    def store(self, root_node: Optional[Root] = None) -> None:
+    def store(self, root_node: Optional[Root] = None, pretty: bool = False) -> None:
         """
-        Stash the database in the JSON file.
+        Stash the database in the JSON file, folding in any journaled
+        modifications.
         This is a two-step process:
-        1. Write the database out to a temporary file
-        2. Move the temporary file over the previous database.
+        1. Write the database out to a temporary file, and flush it to disk
+        2. Move the temporary file over the previous database, and flush the
+           directory entry to disk.
         Step 2 is an atomic operation, ensuring that the database
-        does not get corrupted by an interrupted json.dump.
+        does not get corrupted by an interrupted write.  Flushing the
+        directory makes the move itself survive a crash.
         Parameters
         ----------
         db : dict
             Dictionary to store in JSON.
+        pretty : bool, optional
+            If True, write indented, human-readable JSON.  Defaults to False,
+            writing compact JSON.
         """
         temp_path = self._temp_path()
-        self._root = self.reconstruct_root()
+        root = self.reconstruct_root()
         if root_node is None:
-            serialized = serialize(Root, self._root)
+            serialized = serialize(Root, root)
         else:
             serialized = serialize(Root, Root())
 
+        # serialize in memory, so the file is written in a single call
+        finite = not _has_non_finite(self._entry_cache.values())
+        data = _dumps(serialized, pretty=pretty, finite=finite)
+
         try:
-            with open(temp_path, 'w') as fd:
-                json.dump(serialized, fd, indent=2)
-                fd.write('\n')
+            # preserve the permissions of an existing database
+            try:
+                mode = stat.S_IMODE(os.stat(self.path).st_mode)
+            except FileNotFoundError:
+                mode = None
+
+            with open(temp_path, 'wb') as fd:
+                fd.write(data)
+                fd.flush()
+                os.fsync(fd.fileno())
 
-            if os.path.exists(self.path):
-                shutil.copymode(self.path, temp_path)
-            shutil.move(temp_path, self.path)
+            if mode is not None:
+                os.chmod(temp_path, mode)
+            os.replace(temp_path, self.path)
+            _fsync_directory(self.path)
         except BaseException as ex:
             logger.debug('JSON db move failed: %s', ex, exc_info=ex)
             # remove temporary file
@@ -226,6 +537,44 @@ class FilestoreBackend(_Backend):
                 os.remove(temp_path)
             raise
 
+        # the journal is now part of the database
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_length = 0
+        self._pending_ops = []
+
+    def store_incremental(self) -> None:
+        """
+        Append modifications made since the last store to the journal file,
+        rather than re-writing the whole database.
+
+        Falls back to a full `.store` once the journal would hold more than
+        ``MAX_JOURNAL_LENGTH`` modifications.
+        """
+        if not self._pending_ops:
+            return
+
+        if self._journal_length + len(self._pending_ops) > MAX_JOURNAL_LENGTH:
+            self.store()
+            return
+
+        data = b''.join(self._pending_ops)
+        with open(self.journal_path, 'a+b') as fd:
+            end = fd.seek(0, os.SEEK_END)
+            if end:
+                fd.seek(end - 1)
+                if fd.read(1) != b'\n':
+                    # drop the partial record left by an interrupted append,
+                    # so this one starts on a fresh line
+                    fd.seek(0)
+                    fd.truncate(fd.read().rfind(b'\n') + 1)
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+        self._journal_length += len(self._pending_ops)
+        self._pending_ops = []
+
     def _temp_path(self) -> str:
         """
         Return a temporary path to write the json file to during "store".
@@ -234,7 +583,7 @@ class FilestoreBackend(_Backend):
         """
         directory = os.path.dirname(self.path)
         filename = (
-            f"_{str(uuid4())[:8]}"
+            f"_{os.urandom(4).hex()}"
             f"_{os.path.basename(self.path)}"
         )
         return os.path.join(directory, filename)
@@ -243,21 +592,42 @@ class FilestoreBackend(_Backend):
         """
         Load database from stored path as a nested structure
         """
-        with open(self.path) as fp:
-            serialized = json.load(fp)
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+
+        serialized = _loads(data)
 
+        # release the raw file contents before building the dataclasses
+        del data
         return deserialize(Root, serialized)
 
     @property
     def root(self) -> Root:
-        """Refresh the cache and return the root object"""
-        with self._load_and_store_context():
-            return self._root
+        """
+        Refresh the cache and return the root object.  Root and its entries
+        are copies, see `.get_entry`.
+        """
+        with self._load_and_store_context() as db:
+            # root may hold outdated versions of entries updated since loading
+            return Root(
+                meta_id=self._root.meta_id,
+                entries=[
+                    _copy_entry(db[entry.uuid.int]) for entry in self._root.entries
+                ],
+            )
 
     def get_entry(self, uuid: UUID) -> Entry:
-        """Return the entry with ``uuid``"""
+        """
+        Return the entry with ``uuid``.
+
+        The entry is a copy of the cached version, so modifying it does not
+        change the database until it is passed to `.update_entry`.
+        """
         with self._load_and_store_context() as db:
-            return db.get(uuid)
+            entry = db.get(uuid.int)
+            if entry is None:
+                return None
+            return _copy_entry(entry)
 
     def save_entry(self, entry: Entry) -> None:
         """
@@ -265,24 +635,23 @@ class FilestoreBackend(_Backend):
         Assumes connections are made properly.
         """
         with self._load_and_store_context() as db:
-            if db.get(entry.uuid):
+            if db.get(entry.uuid.int):
                 raise BackendError("Entry already exists, try updating the entry "
                                    "instead of saving it")
-            db[entry.uuid] = entry
-            self._root.entries.append(entry)
+            self._record("save", entry)
 
     def update_entry(self, entry: Entry) -> None:
         """Updates ``entry``.  Looks for references"""
         with self._load_and_store_context() as db:
-            if not db.get(entry.uuid):
+            if not db.get(entry.uuid.int):
                 raise BackendError("Entry does not exist, cannot update")
 
-            db[entry.uuid] = entry
+            self._record("update", entry)
 
     def delete_entry(self, entry: Entry) -> None:
         """Delete meta_id from the system (all instances)"""
-        with self._load_and_store_context() as db:
-            db.pop(entry.uuid, None)
+        with self._load_and_store_context():
+            self._record("delete", entry)
 
     def search(self, **search_kwargs) -> Generator[Entry, None, None]:
         """
@@ -290,6 +659,7 @@ class FilestoreBackend(_Backend):
         Keys are attributes on `Entry` subclasses
         Values can be either a single value to match or a tuple of valid values
         Currently does not support partial matches.
+        Matching entries are copies, see `.get_entry`.
         """
         with self._load_and_store_context() as db:
             for entry in db.values():
@@ -320,14 +690,17 @@ class FilestoreBackend(_Backend):
                         match_found = match_found and matched
 
                 if match_found:
-                    yield entry
+                    yield _copy_entry(entry)
 
     @contextlib.contextmanager
-    def _load_and_store_context(self) -> Generator[Dict[UUID, Any], None, None]:
+    def _load_and_store_context(self) -> Generator[Dict[int, Any], None, None]:
         """
         Context manager used to load, and optionally store the JSON database.
-        Yields the flattened entry cache
+        Yields the flattened entry cache, keyed by ``UUID.int``
+
+        Modifications made within the context are appended to the journal.
         """
         db = self._load_or_initialize()
         yield db
-        self.store()
+        if self._pending_ops:
+            self.store_incremental()
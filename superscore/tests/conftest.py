@@ -5,6 +5,7 @@ from unittest.mock import MagicMock
 
 import pytest
 
+from superscore.backends import filestore
 from superscore.backends.core import _Backend
 from superscore.backends.filestore import FilestoreBackend
 from superscore.backends.test import TestBackend
@@ -710,6 +711,16 @@ def filestore_backend(tmp_path: Path) -> FilestoreBackend:
     return FilestoreBackend(path=tmp_fp)
 
 
+@pytest.fixture(scope='function', params=[True, False], ids=['orjson', 'json'])
+def use_orjson(request, monkeypatch: pytest.MonkeyPatch) -> bool:
+    """Run the filestore backend with orjson, and with the stdlib json module"""
+    if not request.param:
+        monkeypatch.setattr(filestore, 'orjson', None)
+    elif filestore.orjson is None:
+        pytest.skip('orjson not installed')
+    return request.param
+
+
 @pytest.fixture(scope='function')
 def test_backends(filestore_backend: FilestoreBackend) -> List[_Backend]:
     return [filestore_backend,]
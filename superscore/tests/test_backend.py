@@ -1,11 +1,19 @@
+import math
+import os
+import stat
+import sys
+from unittest.mock import MagicMock
 from uuid import UUID
 
 import pytest
 
+from superscore.backends import filestore
 from superscore.backends.core import _Backend
+from superscore.backends.filestore import FilestoreBackend
 from superscore.errors import (BackendError, EntryExistsError,
                                EntryNotFoundError)
-from superscore.model import Collection, Parameter, Snapshot
+from superscore.model import (Collection, Parameter, Readback, Setpoint,
+                              Snapshot)
 
 
 class TestTestBackend:
@@ -118,3 +126,334 @@ def test_update_entry(backends: _Backend):
     p1 = Parameter()
     with pytest.raises(BackendError):
         backends.update_entry(p1)
+
+
+def test_flatten_deep_tree(filestore_backend: FilestoreBackend):
+    # deeper than the default recursion limit.  Only flattening is depth-safe,
+    # storing a tree this deep still recurses through fill_uuids and apischema
+    depth = sys.getrecursionlimit() + 100
+    top = Collection()
+    current = top
+    for _ in range(depth):
+        child = Collection()
+        current.children.append(child)
+        current = child
+
+    filestore_backend.flatten_and_cache(top)
+    assert top.uuid.int in filestore_backend._entry_cache
+    assert current.uuid.int in filestore_backend._entry_cache
+    assert isinstance(top.children[0], UUID)
+
+
+def test_filestore_roundtrip(filestore_backend: FilestoreBackend, use_orjson: bool):
+    # loads, then stores the database
+    root = filestore_backend.root
+    new_backend = FilestoreBackend(path=filestore_backend.path)
+    assert new_backend.root == root
+
+
+@pytest.mark.parametrize('pretty', [True, False])
+def test_filestore_pretty(
+    filestore_backend: FilestoreBackend,
+    use_orjson: bool,
+    pretty: bool,
+):
+    root = filestore_backend.root
+    filestore_backend.store(pretty=pretty)
+    with open(filestore_backend.path) as fp:
+        contents = fp.read()
+
+    assert contents.endswith('\n')
+    assert ('\n  ' in contents) is pretty
+    assert FilestoreBackend(path=filestore_backend.path).root == root
+
+
+def test_filestore_cache_per_instance(filestore_backend: FilestoreBackend, tmp_path):
+    # touch the database to fill the cache
+    filestore_backend.root
+    assert filestore_backend._entry_cache
+
+    other_backend = FilestoreBackend(path=tmp_path / 'other.json')
+    assert other_backend._entry_cache is not filestore_backend._entry_cache
+    assert not other_backend._entry_cache
+
+    filestore_backend.clear_cache()
+    assert not filestore_backend._entry_cache
+    assert filestore_backend._root is None
+    # cache is refilled from the file on next access
+    assert filestore_backend.root.entries
+    assert filestore_backend._entry_cache
+
+
+def test_filestore_cache_reuse(
+    filestore_backend: FilestoreBackend,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    rebuild = MagicMock(wraps=filestore_backend._rebuild_cache)
+    monkeypatch.setattr(filestore_backend, '_rebuild_cache', rebuild)
+
+    filestore_backend.root
+    assert rebuild.call_count == 1
+
+    # warm reads do not re-flatten
+    filestore_backend.root
+    list(filestore_backend.search(entry_type=Collection))
+    assert rebuild.call_count == 1
+
+    # modifications are applied to the cache, rather than rebuilding it
+    new_entry = Parameter()
+    filestore_backend.save_entry(new_entry)
+    assert filestore_backend.get_entry(new_entry.uuid) == new_entry
+    assert rebuild.call_count == 1
+
+
+def test_filestore_reads_return_copies(filestore_backend: FilestoreBackend):
+    uuid = filestore_backend.root.entries[0].uuid
+    original = filestore_backend.get_entry(uuid).description
+
+    # modifying returned entries must not leak into the database
+    filestore_backend.get_entry(uuid).description = "MUTATED"
+    next(filestore_backend.search(uuid=uuid)).description = "MUTATED"
+    filestore_backend.root.entries[0].description = "MUTATED"
+    filestore_backend.save_entry(Parameter())
+    assert filestore_backend.get_entry(uuid).description == original
+    assert FilestoreBackend(path=filestore_backend.path).get_entry(uuid).description == original
+
+    filestore_backend.store()
+    assert FilestoreBackend(path=filestore_backend.path).get_entry(uuid).description == original
+
+    # nor does modifying an entry after saving it
+    entry = Setpoint(pv_name="SAVED", readback=Readback(pv_name="SAVED:RBV"))
+    filestore_backend.save_entry(entry)
+    entry.readback.pv_name = "MUTATED"
+    assert filestore_backend.get_entry(entry.uuid).readback.pv_name == "SAVED:RBV"
+
+
+def test_flatten_shared_entry(filestore_backend: FilestoreBackend):
+    shared = Collection(children=[Parameter()])
+    shared.swap_to_uuids = MagicMock(wraps=shared.swap_to_uuids)
+    top = Collection(children=[Collection(children=[shared]), shared])
+
+    filestore_backend.flatten_and_cache(top)
+    assert shared.swap_to_uuids.call_count == 1
+    assert filestore_backend._entry_cache[shared.uuid.int] is shared
+
+
+def test_filestore_store_keeps_mode(filestore_backend: FilestoreBackend):
+    os.chmod(filestore_backend.path, 0o640)
+    filestore_backend.root
+    filestore_backend.store()
+    assert stat.S_IMODE(os.stat(filestore_backend.path).st_mode) == 0o640
+    # temporary file is moved over the database
+    assert os.listdir(os.path.dirname(filestore_backend.path)) == [
+        os.path.basename(filestore_backend.path)
+    ]
+
+
+def test_filestore_store_fsyncs_directory(
+    filestore_backend: FilestoreBackend,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    fsync_directory = MagicMock(wraps=filestore._fsync_directory)
+    monkeypatch.setattr(filestore, '_fsync_directory', fsync_directory)
+    filestore_backend.root
+    filestore_backend.store()
+    fsync_directory.assert_called_once_with(filestore_backend.path)
+
+
+def test_filestore_read_does_not_store(
+    filestore_backend: FilestoreBackend,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    store = MagicMock(wraps=filestore_backend.store_incremental)
+    monkeypatch.setattr(filestore_backend, 'store_incremental', store)
+
+    entry = filestore_backend.root.entries[0]
+    assert filestore_backend.get_entry(entry.uuid) == entry
+    list(filestore_backend.search(entry_type=Collection))
+    assert store.call_count == 0
+
+    filestore_backend.delete_entry(entry)
+    assert store.call_count == 1
+    assert FilestoreBackend(path=filestore_backend.path).get_entry(entry.uuid) is None
+
+
+def test_filestore_journal(filestore_backend: FilestoreBackend):
+    with open(filestore_backend.path, 'rb') as fp:
+        original_contents = fp.read()
+
+    entry = filestore_backend.root.entries[0]
+    new_entry = Parameter(pv_name="NEW:PV")
+    filestore_backend.save_entry(new_entry)
+    filestore_backend.delete_entry(entry)
+
+    # modifications are journaled, leaving the database file alone
+    with open(filestore_backend.path, 'rb') as fp:
+        assert fp.read() == original_contents
+    with open(filestore_backend.journal_path) as fp:
+        assert len(fp.readlines()) == 2
+
+    # journal is applied when loading
+    new_backend = FilestoreBackend(path=filestore_backend.path)
+    assert new_backend.get_entry(new_entry.uuid) == new_entry
+    assert new_backend.get_entry(entry.uuid) is None
+    assert new_entry.uuid in [e.uuid for e in new_backend.root.entries]
+
+    # a full store folds the journal into the database
+    new_backend.store()
+    assert not os.path.exists(new_backend.journal_path)
+    newest_backend = FilestoreBackend(path=filestore_backend.path)
+    assert newest_backend.get_entry(new_entry.uuid) == new_entry
+    assert newest_backend.get_entry(entry.uuid) is None
+
+
+def test_filestore_journal_applies_to_cache(
+    filestore_backend: FilestoreBackend,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    filestore_backend.root
+    fill_uuids = MagicMock(wraps=filestore_backend.fill_uuids)
+    rebuild = MagicMock(wraps=filestore_backend._rebuild_cache)
+    prune = MagicMock(wraps=filestore_backend._prune_cache)
+    monkeypatch.setattr(filestore_backend, 'fill_uuids', fill_uuids)
+    monkeypatch.setattr(filestore_backend, '_rebuild_cache', rebuild)
+    monkeypatch.setattr(filestore_backend, '_prune_cache', prune)
+
+    # a journaled save only touches the saved entry
+    new_entry = Collection(children=[Parameter(pv_name="NEW:CHILD")])
+    filestore_backend.save_entry(new_entry)
+    cached = filestore_backend.get_entry(new_entry.uuid)
+    assert cached.children == [new_entry.children[0].uuid]
+    assert new_entry.uuid in [e.uuid for e in filestore_backend.root.entries]
+    assert fill_uuids.call_count == 0
+    assert rebuild.call_count == 0
+    assert prune.call_count == 0
+
+    # as does an update that keeps its references
+    new_entry.description = "updated"
+    filestore_backend.update_entry(new_entry)
+    assert filestore_backend.get_entry(new_entry.uuid).description == "updated"
+    assert fill_uuids.call_count == 0
+    assert rebuild.call_count == 0
+    assert prune.call_count == 0
+
+    # dropping references prunes the orphaned entries
+    child_uuid = new_entry.children[0].uuid
+    new_entry.children = []
+    filestore_backend.update_entry(new_entry)
+    assert filestore_backend.get_entry(child_uuid) is None
+    assert fill_uuids.call_count == 0
+    assert rebuild.call_count == 0
+    assert prune.call_count == 1
+
+
+def test_filestore_journal_fold(
+    filestore_backend: FilestoreBackend,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(filestore, 'MAX_JOURNAL_LENGTH', 2)
+    entries = [Parameter() for _ in range(3)]
+    for entry in entries[:2]:
+        filestore_backend.save_entry(entry)
+    assert os.path.exists(filestore_backend.journal_path)
+
+    # third modification would overflow the journal
+    filestore_backend.save_entry(entries[2])
+    assert not os.path.exists(filestore_backend.journal_path)
+
+    new_backend = FilestoreBackend(path=filestore_backend.path)
+    for entry in entries:
+        assert new_backend.get_entry(entry.uuid) == entry
+
+
+@pytest.mark.parametrize('data', [
+    float('nan'), float('inf'), float('-inf'), 2**64, 2**70, -2**63 - 1, -2**70,
+])
+def test_filestore_roundtrip_extreme_values(
+    filestore_backend: FilestoreBackend,
+    use_orjson: bool,
+    data,
+):
+    setpoint = Setpoint(pv_name="EXTREME", data=data)
+    readback = Readback(pv_name="EXTREME:RBV", data=data)
+    filestore_backend.save_entry(setpoint)
+    filestore_backend.save_entry(readback)
+
+    def check(backend: FilestoreBackend):
+        for entry in (setpoint, readback):
+            loaded = backend.get_entry(entry.uuid)
+            assert type(loaded.data) is type(data)
+            if isinstance(data, float) and math.isnan(data):
+                assert math.isnan(loaded.data)
+            else:
+                assert loaded.data == data
+
+    # from the journal
+    check(FilestoreBackend(path=filestore_backend.path))
+
+    # from the database file
+    filestore_backend.store()
+    assert not os.path.exists(filestore_backend.journal_path)
+    check(FilestoreBackend(path=filestore_backend.path))
+
+
+def test_has_non_finite_nested():
+    readback = Readback(pv_name="NESTED:RBV", timeout=1.0)
+    snapshot = Snapshot(children=[Setpoint(pv_name="NESTED", readback=readback)])
+    assert not filestore._has_non_finite([snapshot])
+    readback.timeout = float('inf')
+    assert filestore._has_non_finite([snapshot])
+
+
+def test_filestore_journal_torn_tail(filestore_backend: FilestoreBackend):
+    entry_a = Parameter(pv_name="A")
+    filestore_backend.save_entry(entry_a)
+    # simulate a crash part way through appending a record
+    with open(filestore_backend.journal_path, 'ab') as fp:
+        fp.write(b'{"op":"save","uuid":"12')
+    with open(filestore_backend.journal_path, 'rb') as fp:
+        torn = fp.read()
+
+    # loading ignores the partial record, without modifying the journal
+    backend = FilestoreBackend(path=filestore_backend.path)
+    assert backend.get_entry(entry_a.uuid) == entry_a
+    with open(filestore_backend.journal_path, 'rb') as fp:
+        assert fp.read() == torn
+
+    # the next append drops it
+    entry_c = Parameter(pv_name="C")
+    backend.save_entry(entry_c)
+
+    with open(filestore_backend.journal_path, 'rb') as fp:
+        assert [filestore._loads(line)["uuid"] for line in fp] == [
+            str(entry_a.uuid), str(entry_c.uuid)
+        ]
+    new_backend = FilestoreBackend(path=filestore_backend.path)
+    assert new_backend.get_entry(entry_a.uuid) == entry_a
+    assert new_backend.get_entry(entry_c.uuid) == entry_c
+
+
+def test_filestore_journal_single_flatten(
+    filestore_backend: FilestoreBackend,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    root = filestore_backend.root
+    top = next(entry for entry in root.entries if isinstance(entry, Collection))
+    root_uuids = [entry.uuid for entry in root.entries]
+    child_uuids = [child for child in top.children if child not in root_uuids]
+    assert child_uuids
+    filestore_backend.save_entry(Collection(children=[Parameter()]))
+    filestore_backend.delete_entry(top)
+    # entries only reachable from a deleted entry are dropped
+    for uuid in child_uuids:
+        assert filestore_backend.get_entry(uuid) is None
+
+    new_backend = FilestoreBackend(path=filestore_backend.path)
+    rebuild = MagicMock(wraps=new_backend._rebuild_cache)
+    monkeypatch.setattr(new_backend, '_rebuild_cache', rebuild)
+
+    assert new_backend.get_entry(top.uuid) is None
+    for uuid in child_uuids:
+        assert new_backend.get_entry(uuid) is None
+    assert set(new_backend._entry_cache) == set(filestore_backend._entry_cache)
+    assert rebuild.call_count == 1